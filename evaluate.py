@@ -1,39 +1,132 @@
 import argparse
 import json
 import logging
+import math
 import os
+from contextlib import nullcontext
+from functools import partial
 from pprint import pprint
 
+import orjson
 import torch
 from accelerate import Accelerator
-from transformers import AutoModelForCausalLM, AutoTokenizer
+from transformers import AutoModelForCausalLM, AutoTokenizer, BitsAndBytesConfig
 
-from leia.tasks import get_task
+from leia.tasks import GenerationTask, get_task
 
 logger = logging.getLogger(__name__)
 
+_JSON_SERIALIZABLE_TYPES = (str, bool, type(None))
+
+
+def _is_json_serializable(value: object) -> bool:
+    if isinstance(value, _JSON_SERIALIZABLE_TYPES):
+        return True
+    if isinstance(value, int):
+        # orjson does not support integers wider than 64 bits
+        return -(2**63) <= value < 2**64
+    if isinstance(value, float):
+        # orjson serializes NaN and infinity as null
+        return math.isfinite(value)
+    if isinstance(value, (list, tuple)):
+        return all(_is_json_serializable(v) for v in value)
+    if isinstance(value, dict):
+        return all(isinstance(k, str) and _is_json_serializable(v) for k, v in value.items())
+    return False
+
+
+def _replace_linear_with_te_linear(module: torch.nn.Module, excluded_modules: list[torch.nn.Module]) -> None:
+    import transformer_engine.pytorch as te
+
+    for name, child in module.named_children():
+        if any(child is excluded_module for excluded_module in excluded_modules):
+            continue
+        if isinstance(child, torch.nn.Linear):
+            te_linear = te.Linear(
+                child.in_features,
+                child.out_features,
+                bias=child.bias is not None,
+                params_dtype=child.weight.dtype,
+                device=child.weight.device,
+            )
+            with torch.no_grad():
+                te_linear.weight.copy_(child.weight)
+                if child.bias is not None:
+                    te_linear.bias.copy_(child.bias)
+            setattr(module, name, te_linear)
+        else:
+            _replace_linear_with_te_linear(child, excluded_modules)
+
 
 def evaluate(args: argparse.Namespace):
+    if args.dtype == "bf16" or (args.dtype == "auto" and torch.cuda.is_available() and torch.cuda.is_bf16_supported()):
+        torch_dtype = torch.bfloat16
+    else:
+        torch_dtype = torch.float16
+
+    accelerator = Accelerator()
+
     kwargs = {}
-    if args.use_flash_attention_2:
-        kwargs["use_flash_attention_2"] = True
     if args.device_map is not None:
         kwargs["device_map"] = args.device_map
+    if args.quant == "int8":
+        kwargs["quantization_config"] = BitsAndBytesConfig(load_in_8bit=True)
+        # 8-bit models cannot be moved after loading, so each process loads the model on its own device
+        kwargs.setdefault("device_map", {"": accelerator.local_process_index})
+
+    # None lets transformers select the default attention implementation of the model
+    attn_implementations = ["flash_attention_2", "sdpa", None]
+    if args.use_cuda_graphs:
+        # the FlashAttention-2 kernels cannot be traced by torch.compile and do not support the static KV cache
+        attn_implementations = ["sdpa"]
+    for attn_implementation in attn_implementations:
+        try:
+            model = AutoModelForCausalLM.from_pretrained(
+                args.model_name_or_path,
+                trust_remote_code=True,
+                torch_dtype=torch_dtype,
+                attn_implementation=attn_implementation,
+                **kwargs,
+            )
+            break
+        except (ValueError, ImportError) as e:
+            if attn_implementation == attn_implementations[-1]:
+                raise
+            # ValueError is also raised for reasons unrelated to the attention implementation, so the caught error is
+            # logged to show the actual cause
+            logger.warning(f"Failed to load the model with attention implementation {attn_implementation}: {e}")
+    if args.use_cuda_graphs and not hasattr(model, "_setup_cache"):
+        raise ValueError(f"--use_cuda_graphs requires a model supporting the static KV cache: {type(model).__name__}")
+    model.eval()
+    torch.set_grad_enabled(False)
 
-    model = AutoModelForCausalLM.from_pretrained(
-        args.model_name_or_path,
-        trust_remote_code=True,
-        torch_dtype=torch.float16,
-        **kwargs,
-    )
     max_length = getattr(model.config, "max_position_embeddings", None) if args.max_length is None else args.max_length
     if max_length is None:
         max_length = 2048
 
-    accelerator = Accelerator()
     model = accelerator.prepare(model)
 
-    tokenizer = AutoTokenizer.from_pretrained(args.model_name_or_path, trust_remote_code=True)
+    fp8_autocast = nullcontext
+    if args.quant == "fp8":
+        assert torch.cuda.get_device_capability() >= (9, 0), "FP8 quantization requires Hopper or newer GPUs."
+        import transformer_engine.pytorch as te
+        from transformer_engine.common.recipe import DelayedScaling, Format
+
+        # the layers are replaced after the model is placed on the GPU because Transformer Engine does not support
+        # CPU modules. the output layer is kept in the original precision. note that the weights are stored in the
+        # original dtype, so only the precision of the matrix multiplications is changed
+        unwrapped_model = accelerator.unwrap_model(model)
+        _replace_linear_with_te_linear(unwrapped_model, [unwrapped_model.get_output_embeddings()])
+        fp8_autocast = partial(te.fp8_autocast, enabled=True, fp8_recipe=DelayedScaling(fp8_format=Format.HYBRID))
+        # the maximum length is aligned so that inputs padded to multiples of 16 never exceed it
+        max_length -= max_length % 16
+
+    if args.compile or args.use_cuda_graphs:
+        torch._dynamo.config.cache_size_limit = 64
+    if args.compile:
+        model = torch.compile(model, mode="reduce-overhead", dynamic=False)
+
+    tokenizer = AutoTokenizer.from_pretrained(args.model_name_or_path, trust_remote_code=True, use_fast=True)
     tokenizer.pad_token_id = tokenizer.eos_token_id
 
     tasks = args.tasks.split(",")
@@ -48,6 +141,16 @@ def evaluate(args: argparse.Namespace):
     all_metrics = {}
     for task_name, num_samples in zip(tasks, num_fewshot_samples):
         task_cls = get_task(task_name)
+        task_kwargs = {}
+        if issubclass(task_cls, GenerationTask):
+            task_kwargs["use_prefix_cache"] = args.use_prefix_cache
+            task_kwargs["use_cuda_graphs"] = args.use_cuda_graphs
+        if args.compile or (args.use_cuda_graphs and issubclass(task_cls, GenerationTask)):
+            # input lengths are padded to multiples of 128 so that a limited number of static shapes is compiled
+            task_kwargs["pad_to_multiple_of"] = 128
+        elif args.quant == "fp8":
+            # the FP8 GEMMs of Transformer Engine require the number of tokens to be a multiple of 16
+            task_kwargs["pad_to_multiple_of"] = 16
         task = task_cls(
             model=model,
             accelerator=accelerator,
@@ -56,8 +159,13 @@ def evaluate(args: argparse.Namespace):
             max_length=max_length,
             num_fewshot_samples=num_samples,
             max_samples=args.max_samples,
+            **task_kwargs,
         )
-        result = task.run()
+        # the decoding steps of the generation feed a single token per input, which does not satisfy the alignment
+        # required by the FP8 GEMMs, so the Transformer Engine layers run in the original precision there
+        task_fp8_autocast = nullcontext if issubclass(task_cls, GenerationTask) else fp8_autocast
+        with torch.inference_mode(), task_fp8_autocast():
+            result = task.run()
         if accelerator.is_main_process:
             print(task_name, result.metrics)
 
@@ -66,18 +174,15 @@ def evaluate(args: argparse.Namespace):
                     data = result.metrics.copy()
                     data["num_fewshot_samples"] = num_samples
                     json.dump(data, f, indent=2)
-                with open(os.path.join(args.output_dir, f"{task_name}_predictions.jsonl"), "w") as f:
+                with open(os.path.join(args.output_dir, f"{task_name}_predictions.jsonl"), "wb") as f:
+                    buf = bytearray()
                     for example, prediction in zip(result.examples, result.predictions):
-                        new_example = {}
-                        for key, value in example.items():
-                            try:
-                                json.dumps(value)
-                            except TypeError:
-                                continue
-                            new_example[key] = value
-                        f.write(
-                            f'{json.dumps({"example": new_example, "prediction": prediction}, ensure_ascii=False)}\n'
+                        new_example = {key: value for key, value in example.items() if _is_json_serializable(value)}
+                        buf += orjson.dumps(
+                            {"example": new_example, "prediction": prediction},
+                            option=orjson.OPT_APPEND_NEWLINE,
                         )
+                    f.write(buf)
 
             all_metrics[task_name] = result.metrics
 
@@ -98,7 +203,18 @@ if __name__ == "__main__":
     parser.add_argument("--batch_size", type=int, default=1)
     parser.add_argument("--max_length", type=int, default=None)
     parser.add_argument("--max_samples", type=int, default=None)
-    parser.add_argument("--use_flash_attention_2", action="store_true")
+    parser.add_argument("--dtype", type=str, choices=["auto", "fp16", "bf16"], default="auto")
+    parser.add_argument(
+        "--quant",
+        type=str,
+        choices=["none", "fp8", "int8"],
+        default="none",
+        help="fp8 only runs the matrix multiplications of log-likelihood tasks in FP8 and does not reduce the weight "
+        "memory, while int8 stores the weights in 8 bits",
+    )
+    parser.add_argument("--compile", action="store_true")
+    parser.add_argument("--use_cuda_graphs", action="store_true")
+    parser.add_argument("--use_prefix_cache", action="store_true")
     parser.add_argument("--device_map", type=str, default=None)
     args = parser.parse_args()
 
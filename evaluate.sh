@@ -20,5 +20,4 @@ accelerate launch \
     evaluate.py \
     --model_name_or_path ${MODEL_NAME_OR_PATH} \
     --tasks ${TASKS} \
-    --num_fewshot_samples ${NUM_FEWSHOT_SAMPLES} \
-    --use_flash_attention_2
+    --num_fewshot_samples ${NUM_FEWSHOT_SAMPLES}
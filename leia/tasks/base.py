@@ -2,8 +2,9 @@ import itertools
 import random
 from abc import abstractmethod
 from collections import defaultdict
+from contextlib import contextmanager
 from dataclasses import dataclass
-from typing import Callable
+from typing import Callable, Iterator
 
 import numpy as np
 import torch
@@ -65,6 +66,17 @@ class MultiTokenEOSCriteria(StoppingCriteria):
         return False not in self._done_tracker
 
 
+class MaxGenerationLengthCriteria(StoppingCriteria):
+    """Criteria to stop when the specified number of tokens are generated."""
+
+    def __init__(self, initial_decoder_input_length: int, max_generation_length: int):
+        self._initial_decoder_input_length = initial_decoder_input_length
+        self._max_generation_length = max_generation_length
+
+    def __call__(self, input_ids: torch.Tensor, *args, **kwargs) -> bool:
+        return input_ids.size(1) - self._initial_decoder_input_length >= self._max_generation_length
+
+
 class BaseTask:
     def __init__(
         self,
@@ -78,6 +90,7 @@ class BaseTask:
         num_fewshot_samples: int = 0,
         max_samples: int | None = None,
         aggregation_function: Callable = np.mean,
+        pad_to_multiple_of: int | None = None,
     ):
         self._model = model
         self._accelerator = accelerator
@@ -89,6 +102,7 @@ class BaseTask:
         self._num_fewshot_samples = num_fewshot_samples
         self._max_samples = max_samples
         self._aggregation_function = aggregation_function
+        self._pad_to_multiple_of = pad_to_multiple_of
 
     def run(self) -> TaskResult | None:
         with self._accelerator.main_process_first():
@@ -186,6 +200,13 @@ class BaseTask:
         ret = {key: self._aggregation_function(raw_metrics[key]) for key in raw_metrics.keys()}
         return ret
 
+    def _get_padded_length(self, length: int, max_length: int) -> int:
+        if self._pad_to_multiple_of is None:
+            return length
+        # rounding the length up to a multiple bounds the number of distinct input shapes
+        padded_length = -(-length // self._pad_to_multiple_of) * self._pad_to_multiple_of
+        return max(length, min(padded_length, max_length))
+
     def _is_deepspeed_zero_3(self) -> bool:
         # The following code is obtained from this URL:
         # https://github.com/huggingface/peft/blob/59778af504ddf368ae05cf9e009367cd872304e3/examples/conditional_generation/peft_lora_seq2seq_accelerate_ds_zero3_offload.py#L188
@@ -196,13 +217,16 @@ class BaseTask:
 
 class LoglikelihoodTask(BaseTask):
     def _compute_results(self, requests: list[LogLikelihoodRequest]) -> list[float]:
+        # all texts are tokenized in a single call to make use of batch encoding of the fast tokenizer
+        contexts = [r.context for r in requests]
+        continuations = [r.continuation for r in requests]
+        all_context_ids = self._tokenizer(contexts, add_special_tokens=False)["input_ids"]
+        all_continuation_ids = self._tokenizer(continuations, add_special_tokens=False)["input_ids"]
+
         inputs = []
-        for request in requests:
+        for request, context_ids, continuation_ids in zip(requests, all_context_ids, all_continuation_ids):
             if request.context == "":
                 context_ids = [self._tokenizer.eos_token_id]
-            else:
-                context_ids = self._tokenizer.encode(request.context, add_special_tokens=False)
-            continuation_ids = self._tokenizer.encode(request.continuation, add_special_tokens=False)
 
             if len(context_ids) + len(continuation_ids) > self._max_length:
                 context_ids = context_ids[-(self._max_length - len(continuation_ids) + 1) :]
@@ -229,6 +253,10 @@ class LoglikelihoodTask(BaseTask):
                 input_ids_tensor = torch.nn.utils.rnn.pad_sequence(
                     input_ids, batch_first=True, padding_value=pad_token_id
                 )
+                padded_length = self._get_padded_length(input_ids_tensor.size(1), self._max_length)
+                input_ids_tensor = F.pad(
+                    input_ids_tensor, (0, padded_length - input_ids_tensor.size(1)), value=pad_token_id
+                )
                 input_ids_tensor = self._accelerator.pad_across_processes(
                     input_ids_tensor, dim=1, pad_index=pad_token_id
                 )
@@ -261,15 +289,40 @@ class LoglikelihoodTask(BaseTask):
 
 
 class GenerationTask(BaseTask):
-    def __init__(self, *args, use_dynamic_generation_length: bool = True, **kwargs):
+    def __init__(
+        self,
+        *args,
+        use_dynamic_generation_length: bool = True,
+        use_prefix_cache: bool = False,
+        use_cuda_graphs: bool = False,
+        **kwargs,
+    ):
         super().__init__(*args, **kwargs)
         self._use_dynamic_generation_length = use_dynamic_generation_length
+        self._use_prefix_cache = use_prefix_cache
+        self._use_cuda_graphs = use_cuda_graphs
+        self._compiled_forward = None
+        # the prefix is computed per batch and may differ across processes, which is not supported when the model
+        # forward passes need to be synchronized across processes
+        if self._use_prefix_cache and self._is_deepspeed_zero_3():
+            raise ValueError("The prefix cache cannot be used with DeepSpeed ZeRO-3.")
+        # the KV cache of the prefix cannot be passed to the generation when the static KV cache is used
+        if self._use_prefix_cache and self._use_cuda_graphs:
+            raise ValueError("The prefix cache cannot be used with CUDA graphs.")
 
     def _compute_results(self, requests: list[GenerationRequest]) -> list[str]:
-        # longer inputs are processed first
-        inputs_with_indices = sorted(
-            enumerate(requests), key=lambda o: len(self._tokenizer.encode(o[1].context)), reverse=True
-        )
+        max_context_length = self._max_length - self._max_generation_length
+        all_context_ids = self._tokenizer([r.context for r in requests], add_special_tokens=False)["input_ids"]
+        inputs = []
+        for request, context_ids in zip(requests, all_context_ids):
+            max_generation_length = self._max_generation_length
+            if self._use_dynamic_generation_length and request.max_generation_length is not None:
+                max_generation_length = request.max_generation_length
+            inputs.append((context_ids[-max_context_length:], max_generation_length))
+
+        # requests are bucketed by the generation length and the context length so that each batch contains inputs
+        # of similar shapes, and longer inputs are processed first
+        inputs_with_indices = sorted(enumerate(inputs), key=lambda o: (o[1][1], len(o[1][0])), reverse=True)
         all_generated_texts = [None] * len(inputs_with_indices)
         pad_token_id = self._tokenizer.pad_token_id
 
@@ -278,27 +331,39 @@ class GenerationTask(BaseTask):
 
         model = self._accelerator.unwrap_model(self._model)
 
-        batch_size = 1
         with self._accelerator.split_between_processes(
             inputs_with_indices, apply_padding=True
         ) as split_inputs_with_indices:
             for start_idx in trange(
-                0, len(split_inputs_with_indices), batch_size, disable=not self._accelerator.is_local_main_process
+                0, len(split_inputs_with_indices), self._batch_size, disable=not self._accelerator.is_local_main_process
             ):
                 batch = split_inputs_with_indices[start_idx : start_idx + self._batch_size]
-                batch_requests: list[GenerationRequest] = [o[1] for o in batch]
-                inputs = self._tokenizer(
-                    [r.context for r in batch_requests], return_tensors="pt", padding=True, add_special_tokens=False
+
+                prefix_ids, prefix_past_key_values = [], None
+                if self._use_prefix_cache:
+                    prefix_ids, prefix_past_key_values = self._compute_prefix_cache(
+                        model, [context_ids for _, (context_ids, _) in batch]
+                    )
+                prefix_length = len(prefix_ids)
+
+                # inputs are left-padded so that the generation starts right after the context. if the prefix cache is
+                # used, the padding is placed between the shared prefix and the rest of each context
+                max_input_length = self._get_padded_length(
+                    max(len(context_ids) for _, (context_ids, _) in batch), max_context_length
                 )
-                input_ids = inputs["input_ids"][:, self._max_generation_length - self._max_length :]
+                input_ids = torch.full((len(batch), max_input_length), pad_token_id, dtype=torch.long)
+                attention_mask = torch.zeros((len(batch), max_input_length), dtype=torch.long)
+                input_ids[:, :prefix_length] = torch.tensor(prefix_ids, dtype=torch.long)
+                attention_mask[:, :prefix_length] = 1
+                for index, (_, (context_ids, _)) in enumerate(batch):
+                    suffix_ids = context_ids[prefix_length:]
+                    if suffix_ids:
+                        input_ids[index, -len(suffix_ids) :] = torch.tensor(suffix_ids, dtype=torch.long)
+                        attention_mask[index, -len(suffix_ids) :] = 1
                 input_ids = input_ids.to(self._accelerator.device)
-
-                attention_mask = inputs["attention_mask"][:, self._max_generation_length - self._max_length :]
                 attention_mask = attention_mask.to(self._accelerator.device)
 
-                max_generation_length = self._max_generation_length
-                if self._use_dynamic_generation_length and batch_requests[0].max_generation_length is not None:
-                    max_generation_length = max(r.max_generation_length for r in batch_requests)
+                max_generation_length = max(generation_length for _, (_, generation_length) in batch)
 
                 stopping_criteria = StoppingCriteriaList(
                     [
@@ -306,14 +371,33 @@ class GenerationTask(BaseTask):
                         for sequence in stop_sequences
                     ]
                 )
-                with torch.no_grad():
+                generation_kwargs = {}
+                if self._use_cuda_graphs:
+                    # the static KV cache keeps the shapes of the decoding steps fixed so that they can be captured as
+                    # CUDA graphs. the length of the cache is determined by the input length and max_new_tokens, so
+                    # max_new_tokens is set to make the cache length always equal to the maximum length, and the
+                    # generation length of the batch is enforced by the stopping criteria instead
+                    generation_kwargs["cache_implementation"] = "static"
+                    stopping_criteria.append(MaxGenerationLengthCriteria(input_ids.size(1), max_generation_length))
+                    max_generation_length = self._max_length - input_ids.size(1)
+                if prefix_past_key_values is not None:
+                    # the cache of the prefix is shared by all inputs in the batch; new tensors are created when the
+                    # cache is extended during generation, so the expanded views are never modified in place
+                    generation_kwargs["past_key_values"] = tuple(
+                        tuple(tensor.expand(len(batch), *tensor.shape[1:]) for tensor in layer_past_key_values)
+                        for layer_past_key_values in prefix_past_key_values
+                    )
+
+                with torch.no_grad(), self._compiled_forward_context(model):
                     generated_ids = model.generate(
                         input_ids=input_ids,
                         attention_mask=attention_mask,
                         max_new_tokens=max_generation_length,
                         stopping_criteria=stopping_criteria,
                         do_sample=False,
+                        pad_token_id=pad_token_id,
                         synced_gpus=self._is_deepspeed_zero_3(),
+                        **generation_kwargs,
                     )
                 generated_ids = generated_ids[:, input_ids.size(1) :]
                 generated_ids = self._accelerator.pad_across_processes(generated_ids, dim=1, pad_index=pad_token_id)
@@ -329,3 +413,64 @@ class GenerationTask(BaseTask):
                         all_generated_texts[idx] = response
 
         return all_generated_texts
+
+    def _compute_prefix_cache(
+        self, model: PreTrainedModel, all_context_ids: list[list[int]]
+    ) -> tuple[list[int], tuple | None]:
+        # sharing the prefix cache is only beneficial if the batch contains multiple inputs
+        if len(all_context_ids) < 2:
+            return [], None
+
+        # at least one token of each context needs to be fed to the model at the start of the generation
+        prefix_length = min(len(context_ids) for context_ids in all_context_ids) - 1
+        if prefix_length <= 0:
+            return [], None
+
+        first_context_ids = all_context_ids[0]
+        for context_ids in all_context_ids[1:]:
+            prefix_length = next(
+                (i for i, (a, b) in enumerate(zip(first_context_ids[:prefix_length], context_ids)) if a != b),
+                prefix_length,
+            )
+        if prefix_length <= 0:
+            return [], None
+
+        prefix_ids = first_context_ids[:prefix_length]
+        # the prefix length differs across batches, so the prefix is encoded without the torch.compile wrapper to
+        # avoid recompiling the model for each batch
+        model = getattr(model, "_orig_mod", model)
+        with torch.no_grad():
+            past_key_values = model(
+                torch.tensor([prefix_ids], dtype=torch.long, device=self._accelerator.device), use_cache=True
+            ).past_key_values
+        if hasattr(past_key_values, "to_legacy_cache"):
+            past_key_values = past_key_values.to_legacy_cache()
+        if any(tensor.size(0) != 1 for layer_past_key_values in past_key_values for tensor in layer_past_key_values):
+            raise ValueError("The prefix cache requires a model whose KV cache has the batch dimension first.")
+
+        return prefix_ids, past_key_values
+
+    @contextmanager
+    def _compiled_forward_context(self, model: PreTrainedModel) -> Iterator[None]:
+        # the compiled forward is only used during the generation so that other forward passes are not affected
+        if not self._use_cuda_graphs:
+            yield
+            return
+
+        # generate() of a module wrapped by torch.compile runs the original module
+        model = getattr(model, "_orig_mod", model)
+        if self._compiled_forward is None:
+            self._compiled_forward = torch.compile(model.forward, mode="reduce-overhead", fullgraph=True)
+
+        original_forward = model.__dict__.get("forward")
+        model.forward = self._compiled_forward
+        try:
+            yield
+        finally:
+            if original_forward is None:
+                del model.forward
+            else:
+                model.forward = original_forward
+            # the static KV cache remains attached to the attention layers after the generation and would be used by
+            # subsequent forward passes
+            model._reset_cache()
@@ -1,6 +1,5 @@
 import argparse
 import logging
-import os
 
 import datasets
 from transformers import AutoTokenizer
@@ -11,6 +10,7 @@ logger = logging.getLogger(__name__)
 
 BLUE = "\033[1;34m"
 RESET = "\033[0;0m"
+CLEAR = "\033[H\033[2J"
 
 
 def main(args: argparse.Namespace) -> None:
@@ -34,7 +34,7 @@ def main(args: argparse.Namespace) -> None:
     )
     collator = LeiaDataCollator(tokenizer=tokenizer, max_length=args.max_length)
     for example in dataset:
-        os.system("clear")
+        print(CLEAR, end="")
         example = collator([example])
         text = tokenizer.decode(example["input_ids"][0])
         text = text.replace("<translate>", f"{BLUE}<translate>{RESET}")